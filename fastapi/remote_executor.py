@@ -1,74 +1,312 @@
 import uuid
 import asyncio
+import bisect
+import fcntl
+import functools
+import heapq
+import itertools
 import re
 import time
 import os
 import shutil
+import stat
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query
-from fastapi.responses import FileResponse, StreamingResponse
-from pydantic import BaseModel
+import msgspec
+import orjson
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Query
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
-app = FastAPI(title="Remote Executor", version="2.0.0")
 
 # ---------------------------------------------------------------------------
 # Configuration
 # ---------------------------------------------------------------------------
 BASE_DIR = Path("/").resolve()
 COMFY_OUTPUT_DIR = Path("/workspace/ComfyUI/output").resolve()
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+READ_CHUNK_SIZE = 1 << 16  # 64 KiB per subprocess stdout read
+PIPE_BUFFER_SIZE = 1 << 20  # kernel buffer for subprocess stdout, default is 64 KiB
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+MAX_OUTPUT_BYTES = 32 << 20  # keep at most 32 MiB of output per job
 JOB_TTL_SECONDS = 3600  # auto-purge finished jobs after 1 hour
+PURGE_INTERVAL_SECONDS = 60
+BROWSE_MAX_LIMIT = 100_000
+STREAM_KEEPALIVE_SECONDS = 5.0
+MAX_PARALLEL_JOBS = int(os.environ.get("MAX_PARALLEL_JOBS", "4"))
+TERMINAL_STATUSES = ("finished", "error", "cancelled", "timeout")
+# Environment captured at startup; only copied when a request adds env vars.
+BASE_ENV = dict(os.environ)
 
 # ---------------------------------------------------------------------------
 # In-memory job store
 # ---------------------------------------------------------------------------
-jobs: dict[str, dict] = {}
+jobs: dict[str, "Job"] = {}
+
+# Min-heap of (expires_at, job_id), pushed when a job reaches a terminal
+# state so purging only touches jobs that have actually expired.
+_expiry_heap: list[tuple[float, str]] = []
+
+# Jobs beyond MAX_PARALLEL_JOBS wait in "queued" until a slot frees up.
+_job_sem = asyncio.Semaphore(MAX_PARALLEL_JOBS)
 
 
 # ---------------------------------------------------------------------------
 # Models
 # ---------------------------------------------------------------------------
-class CommandRequest(BaseModel):
+class CommandRequest(msgspec.Struct):
     command: str
     cwd: Optional[str] = None
     timeout: int = 1200  # 20 minutes
     env: Optional[dict[str, str]] = None  # extra env vars
 
 
+@dataclass(slots=True)
+class Job:
+    command: str
+    cwd: Optional[str]
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    # Raw output bytes, plus the end offset of each line for the SSE stream;
+    # decoding is deferred until the output is actually read. Offsets are
+    # absolute: output_buf holds the bytes from `dropped` onwards.
+    output_buf: bytearray = field(default_factory=bytearray)
+    offsets: list[int] = field(default_factory=list)
+    dropped: int = 0
+    event: asyncio.Event = field(default_factory=asyncio.Event)  # replaced by notify()
+    process: Optional[asyncio.subprocess.Process] = None
+    task: Optional[asyncio.Task] = None
+    returncode: Optional[int] = None
+    error: Optional[str] = None
+
+    def notify(self):
+        """Wake everyone waiting for new output or a status change.
+
+        The event is set and swapped for a fresh one rather than cleared, so
+        a stream that grabbed `event` before rendering can't have the wakeup
+        wiped by another stream on the same job.
+        """
+        self.event.set()
+        self.event = asyncio.Event()
+
+    @property
+    def total_bytes(self) -> int:
+        return self.dropped + len(self.output_buf)
+
+    def append_output(self, chunk: bytes):
+        pos = len(self.output_buf)
+        self.output_buf.extend(chunk)
+        while (nl := self.output_buf.find(b"\n", pos)) != -1:
+            pos = nl + 1
+            self.offsets.append(self.dropped + pos)
+        if len(self.output_buf) > MAX_OUTPUT_BYTES:
+            self._trim_output()
+        self.notify()
+
+    def end_output(self):
+        """Record a trailing partial line once no more output will arrive."""
+        if self.total_bytes > (self.offsets[-1] if self.offsets else self.dropped):
+            self.offsets.append(self.total_bytes)
+
+    def _trim_output(self):
+        # Drop at least enough to get back under half the cap, then keep
+        # cutting up to the next line boundary so the buffer starts on a
+        # whole line. That boundary is in the tail, so less than half the
+        # cap may remain; with no boundary left, cut exactly at the target.
+        target = self.total_bytes - MAX_OUTPUT_BYTES // 2
+        i = bisect.bisect_left(self.offsets, target)
+        cut = self.offsets[i] if i < len(self.offsets) else target
+        del self.offsets[:bisect.bisect_right(self.offsets, cut)]
+        del self.output_buf[:cut - self.dropped]
+        self.dropped = cut
+
+    def output_text(self) -> str:
+        text = self.output_buf.decode(errors="replace")
+        if self.dropped:
+            text = truncation_marker(self.dropped) + text
+        return text
+
+    def sse_events(self, start: int) -> tuple[str, int]:
+        """Render complete lines from absolute offset `start` as SSE events.
+
+        Returns the events and the offset to resume from.
+        """
+        events = []
+        if start < self.dropped:
+            events.append(f"data: {truncation_marker(self.dropped - start)}\n")
+            start = self.dropped
+        for end in self.offsets[bisect.bisect_right(self.offsets, start):]:
+            line = self.output_buf[start - self.dropped:end - self.dropped]
+            events.append(f"data: {line.decode(errors='replace')}\n")
+            start = end
+        return "".join(events), start
+
+
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
-BLOCKED_PATTERNS = [
-    re.compile(r"^(sudo\s+)?rm\s+(-[a-z]*f[a-z]*\s+)?/\s*$", re.I),  # rm -rf /
-    re.compile(r"^(sudo\s+)?ls\s+(-[a-z]*r[a-z]*)", re.I),            # ls -R
-]
+BLOCKED_PATTERN = re.compile(
+    r"^(?:sudo\s+)?(?:"
+    r"(?P<rm_rf_root>rm\s+(?:-[a-z]*f[a-z]*\s+)?/\s*$)"  # rm -rf /
+    r"|(?P<ls_recursive>ls\s+-[a-z]*r[a-z]*)"            # ls -R
+    r")",
+    re.I,
+)
+WHITESPACE_RE = re.compile(r"\s+")
 
 
 def is_blocked_command(command: str) -> Optional[str]:
-    cmd = re.sub(r"\s+", " ", command.strip())
-    for pattern in BLOCKED_PATTERNS:
-        if pattern.search(cmd):
-            return f"Blocked: command matches dangerous pattern ({pattern.pattern})"
+    cmd = WHITESPACE_RE.sub(" ", command.strip())
+    match = BLOCKED_PATTERN.search(cmd)
+    if match:
+        return f"Blocked: command matches dangerous pattern ({match.lastgroup})"
     return None
 
 
+def truncation_marker(size: int) -> str:
+    return f"...[truncated {size} bytes]...\n"
+
+
 def safe_path(path: str) -> Path:
     resolved = Path(path).resolve()
     return resolved
 
 
+async def spawn_shell(
+    command: str, cwd: Path, env: Optional[dict[str, str]]
+) -> tuple[asyncio.subprocess.Process, asyncio.StreamReader, asyncio.ReadTransport]:
+    """Start `command` with stdout+stderr on a pipe with an enlarged buffer.
+
+    We create the pipe ourselves rather than using subprocess.PIPE: uvloop
+    hands the child a socketpair instead, whose buffer can't be grown from
+    our end.
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(write_fd, F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+    except OSError:
+        pass  # above /proc/sys/fs/pipe-max-size; keep the default
+    pipe = os.fdopen(read_fd, "rb", buffering=0)
+    try:
+        proc = await asyncio.create_subprocess_shell(
+            command,
+            cwd=str(cwd),
+            stdout=write_fd,
+            stderr=asyncio.subprocess.STDOUT,
+            env=env,
+        )
+    except BaseException:
+        pipe.close()
+        raise
+    finally:
+        os.close(write_fd)
+
+    # The child is already running but the caller doesn't have it yet, so a
+    # cancellation here would otherwise leave it orphaned.
+    reader = asyncio.StreamReader()
+    loop = asyncio.get_running_loop()
+    try:
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe
+        )
+    except BaseException:
+        kill_process(proc)
+        pipe.close()
+        raise
+    return proc, reader, transport
+
+
+def kill_process(proc: asyncio.subprocess.Process):
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+
+
+def copy_upload(src, dst: str):
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    with os.fdopen(fd, "wb", buffering=UPLOAD_CHUNK_SIZE) as out:
+        shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+
+
+def schedule_expiry(job_id: str, finished_at: float):
+    heapq.heappush(_expiry_heap, (finished_at + JOB_TTL_SECONDS, job_id))
+
+
+def finish_job(job_id: str, status: str):
+    job = jobs[job_id]
+    job.status = status
+    job.finished_at = time.time()
+    job.notify()
+    schedule_expiry(job_id, job.finished_at)
+
+
+def _job_task_done(job_id: str, task: asyncio.Task):
+    # run() records its own errors; this catches anything that escapes it.
+    if task.cancelled() or task.exception() is None:
+        return
+    job = jobs.get(job_id)
+    if job is None:
+        return
+    job.error = str(task.exception())
+    if job.status not in TERMINAL_STATUSES:
+        finish_job(job_id, "error")
+
+
 def purge_old_jobs():
     now = time.time()
-    expired = [
-        jid for jid, job in jobs.items()
-        if job["status"] in ("finished", "error", "cancelled", "timeout")
-        and now - job.get("finished_at", now) > JOB_TTL_SECONDS
-    ]
-    for jid in expired:
+    while _expiry_heap and _expiry_heap[0][0] <= now:
+        _, jid = heapq.heappop(_expiry_heap)
+        job = jobs.get(jid)
+        # Stale entries (already purged, or re-finished with a later deadline)
+        # are skipped; the newer heap entry takes care of them.
+        if job is None or job.status not in TERMINAL_STATUSES:
+            continue
+        if job.finished_at + JOB_TTL_SECONDS > now:
+            continue
+        if job.task and not job.task.done():
+            job.task.cancel()
         del jobs[jid]
 
 
+async def _purge_loop():
+    try:
+        while True:
+            await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+            purge_old_jobs()
+    except asyncio.CancelledError:
+        pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        COMFY_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        pass  # /files treats a missing directory as empty
+    purger = asyncio.create_task(_purge_loop())
+    try:
+        yield
+    finally:
+        purger.cancel()
+
+
+app = FastAPI(
+    title="Remote Executor",
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+
+
 # ---------------------------------------------------------------------------
 # Endpoints
 # ---------------------------------------------------------------------------
@@ -79,79 +317,76 @@ async def health():
 
 
 @app.post("/exec")
-async def exec_command(req: CommandRequest):
-    purge_old_jobs()
+async def exec_command(request: Request):
+    # Decoded with msgspec straight from the body rather than through
+    # FastAPI's Pydantic validation.
+    try:
+        req = msgspec.json.decode(await request.body(), type=CommandRequest)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
     blocked = is_blocked_command(req.command)
     if blocked:
         raise HTTPException(status_code=400, detail=blocked)
 
     job_id = str(uuid.uuid4())
-    output_lines: list[str] = []
-
-    jobs[job_id] = {
-        "status": "running",
-        "command": req.command,
-        "cwd": req.cwd,
-        "created_at": time.time(),
-        "output_lines": output_lines,
-        "process": None,
-    }
+    job = Job(command=req.command, cwd=req.cwd)
+    jobs[job_id] = job
 
     async def run():
         proc = None
-        try:
-            env = os.environ.copy()
-            if req.env:
-                env.update(req.env)
-
-            cwd = safe_path(req.cwd) if req.cwd else BASE_DIR
-            proc = await asyncio.create_subprocess_shell(
-                req.command,
-                cwd=str(cwd),
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.STDOUT,
-                env=env,
-            )
-            jobs[job_id]["process"] = proc
-
-            async def read_stream():
-                while True:
-                    line = await proc.stdout.readline()
-                    if not line:
-                        break
-                    output_lines.append(line.decode(errors="replace"))
-
+        transport = None
+        async with _job_sem:
+            job.status = "running"
+            job.notify()
             try:
-                await asyncio.wait_for(read_stream(), timeout=req.timeout)
-            except asyncio.TimeoutError:
-                proc.kill()
+                env = {**BASE_ENV, **req.env} if req.env else None
+
+                cwd = safe_path(req.cwd) if req.cwd else BASE_DIR
+                proc, stdout, transport = await spawn_shell(req.command, cwd, env)
+                job.process = proc
+
+                async def read_stream():
+                    # Read in bulk and split on newlines ourselves; a trailing
+                    # partial line stays in the buffer until its newline arrives.
+                    try:
+                        while True:
+                            chunk = await stdout.read(READ_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            job.append_output(chunk)
+                    finally:
+                        job.end_output()
+
+                try:
+                    await asyncio.wait_for(read_stream(), timeout=req.timeout)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+                    job.returncode = -1
+                    finish_job(job_id, "timeout")
+                    return
+
                 await proc.wait()
-                jobs[job_id].update({
-                    "status": "timeout",
-                    "stdout": "".join(output_lines),
-                    "stderr": "",
-                    "returncode": -1,
-                    "finished_at": time.time(),
-                })
-                return
-
-            await proc.wait()
-            jobs[job_id].update({
-                "status": "finished",
-                "stdout": "".join(output_lines),
-                "stderr": "",
-                "returncode": proc.returncode,
-                "finished_at": time.time(),
-            })
-        except Exception as e:
-            jobs[job_id].update({
-                "status": "error",
-                "error": str(e),
-                "finished_at": time.time(),
-            })
-
-    asyncio.create_task(run())
+                job.returncode = proc.returncode
+                finish_job(job_id, "finished")
+            except asyncio.CancelledError:
+                # cancel_job only kills job.process; make sure a child that
+                # wasn't recorded there yet doesn't outlive the job.
+                if proc and proc.returncode is None:
+                    kill_process(proc)
+                raise
+            except Exception as e:
+                job.error = str(e)
+                finish_job(job_id, "error")
+            finally:
+                if transport:
+                    transport.close()
+
+    # Keep a reference on the job so the task can't be garbage collected
+    # mid-run, and so cancel_job can stop it.
+    job.task = asyncio.create_task(run(), name=f"job-{job_id}")
+    job.task.add_done_callback(functools.partial(_job_task_done, job_id))
     return {"job_id": job_id}
 
 
@@ -161,20 +396,39 @@ async def stream_output(job_id: str):
     if job_id not in jobs:
         raise HTTPException(status_code=404, detail="Job not found")
 
+    # A finished job's output can't change, so send it in one response.
+    job = jobs[job_id]
+    if job.status in TERMINAL_STATUSES:
+        events, _ = job.sse_events(0)
+        return Response(
+            content=f"{events}event: done\ndata: {job.status}\n\n",
+            media_type="text/event-stream",
+        )
+
     async def event_generator():
-        idx = 0
+        start = 0  # absolute offset of the next line to send
         while True:
             job = jobs.get(job_id)
             if not job:
                 break
-            lines = job.get("output_lines", [])
-            while idx < len(lines):
-                yield f"data: {lines[idx]}\n"
-                idx += 1
-            if job["status"] != "running":
-                yield f"event: done\ndata: {job['status']}\n\n"
+            # Grab the event before rendering: anything that arrives from here
+            # on, including while we're parked at the yield, sets it.
+            changed = job.event
+            # Send every buffered line in one write per wakeup; rendering
+            # happens before the yield since the buffer may be trimmed while
+            # the generator is suspended.
+            events, start = job.sse_events(start)
+            if events:
+                yield events
+            if job.status in TERMINAL_STATUSES:
+                yield f"event: done\ndata: {job.status}\n\n"
                 break
-            await asyncio.sleep(0.3)
+            # Sleep until read_stream or a status change wakes us; the
+            # timeout only re-checks that the job hasn't been purged.
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=STREAM_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
@@ -186,8 +440,8 @@ async def status(job_id: str):
     job = jobs[job_id]
     return {
         "job_id": job_id,
-        "status": job["status"],
-        "command": job.get("command", ""),
+        "status": job.status,
+        "command": job.command,
     }
 
 
@@ -198,11 +452,12 @@ async def result(job_id: str):
     job = jobs[job_id]
     return {
         "job_id": job_id,
-        "status": job["status"],
-        "stdout": job.get("stdout", ""),
-        "stderr": job.get("stderr", ""),
-        "returncode": job.get("returncode"),
-        "error": job.get("error"),
+        "status": job.status,
+        "stdout": job.output_text() if job.status in TERMINAL_STATUSES else "",
+        "stderr": "",
+        "total_bytes": job.total_bytes,
+        "returncode": job.returncode,
+        "error": job.error,
     }
 
 
@@ -211,28 +466,25 @@ async def cancel_job(job_id: str):
     if job_id not in jobs:
         raise HTTPException(status_code=404, detail="Job not found")
     job = jobs[job_id]
-    if job["status"] != "running":
-        return {"message": f"Job is already {job['status']}"}
-    proc = job.get("process")
-    if proc:
-        try:
-            proc.kill()
-        except ProcessLookupError:
-            pass
-    job.update({"status": "cancelled", "finished_at": time.time()})
+    if job.status in TERMINAL_STATUSES:
+        return {"message": f"Job is already {job.status}"}
+    if job.process:
+        kill_process(job.process)
+    if job.task:
+        job.task.cancel()
+    finish_job(job_id, "cancelled")
     return {"message": "Job cancelled"}
 
 
 @app.get("/jobs")
 async def list_jobs():
-    purge_old_jobs()
     return {
         "jobs": [
             {
                 "job_id": jid,
-                "status": job["status"],
-                "command": job.get("command", ""),
-                "created_at": job.get("created_at"),
+                "status": job.status,
+                "command": job.command,
+                "created_at": job.created_at,
             }
             for jid, job in jobs.items()
         ]
@@ -244,8 +496,12 @@ async def list_jobs():
 # ---------------------------------------------------------------------------
 
 @app.get("/browse")
-async def browse(path: str = Query(default="/workspace")):
-    """List contents of a directory."""
+async def browse(
+    path: str = Query(default="/workspace"),
+    limit: int = Query(default=1000, ge=0, le=BROWSE_MAX_LIMIT),  # 0 = no limit
+    sort: bool = Query(default=True),
+):
+    """List contents of a directory, up to `limit` entries."""
     target = Path(path).resolve()
     if not target.exists():
         raise HTTPException(status_code=404, detail="Path not found")
@@ -254,20 +510,36 @@ async def browse(path: str = Query(default="/workspace")):
 
     entries = []
     try:
-        for item in sorted(target.iterdir()):
+        # DirEntry caches its stat result, so each entry costs one stat(2)
+        # instead of separate stat/is_dir/is_file calls.
+        # With a limit, fetch one extra entry to tell whether we truncated;
+        # nsmallest avoids sorting the whole directory for that.
+        with os.scandir(target) as it:
+            if sort and limit:
+                items = heapq.nsmallest(limit + 1, it, key=lambda e: e.name)
+            elif sort:
+                items = sorted(it, key=lambda e: e.name)
+            elif limit:
+                items = list(itertools.islice(it, limit + 1))
+            else:
+                items = list(it)
+        truncated = bool(limit) and len(items) > limit
+        if truncated:
+            items = items[:limit]
+        for item in items:
             try:
-                stat = item.stat()
+                st = item.stat()
                 entries.append({
                     "name": item.name,
                     "type": "dir" if item.is_dir() else "file",
-                    "size": stat.st_size if item.is_file() else None,
+                    "size": st.st_size if item.is_file() else None,
                 })
-            except PermissionError:
+            except OSError:
                 entries.append({"name": item.name, "type": "unknown", "size": None})
     except PermissionError:
         raise HTTPException(status_code=403, detail="Permission denied")
 
-    return {"path": str(target), "entries": entries}
+    return {"path": str(target), "entries": entries, "truncated": truncated}
 
 
 @app.post("/upload")
@@ -280,9 +552,8 @@ async def upload_file(
     dest.mkdir(parents=True, exist_ok=True)
     file_path = dest / file.filename
 
-    with open(file_path, "wb") as f:
-        while chunk := await file.read(1024 * 1024):
-            f.write(chunk)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, copy_upload, file.file, str(file_path))
 
     return {
         "message": "File uploaded",
@@ -294,27 +565,40 @@ async def upload_file(
 @app.get("/files")
 async def list_generated_files():
     """List ComfyUI output files."""
-    if not COMFY_OUTPUT_DIR.exists():
-        return {"files": []}
     files = []
-    for f in COMFY_OUTPUT_DIR.iterdir():
-        if f.is_file():
-            files.append({"name": f.name, "size": f.stat().st_size})
+    try:
+        with os.scandir(COMFY_OUTPUT_DIR) as it:
+            for f in it:
+                if f.is_file():
+                    files.append({"name": f.name, "size": f.stat().st_size})
+    except FileNotFoundError:
+        pass
     return {"files": files}
 
 
 @app.get("/files/{filename}")
 async def get_generated_file(filename: str):
     """Download a ComfyUI output file."""
-    file_path = (COMFY_OUTPUT_DIR / filename).resolve()
-    if not str(file_path).startswith(str(COMFY_OUTPUT_DIR)):
-        raise HTTPException(status_code=403, detail="Invalid file path")
-    if not file_path.exists():
+    # Only plain names directly inside the output dir are served, so only
+    # symlinks need resolving to check they don't point outside it.
+    if filename in ("", ".", "..") or any(c in filename for c in "/\\\x00"):
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    file_path = COMFY_OUTPUT_DIR / filename
+    try:
+        st = file_path.lstat()
+        if stat.S_ISLNK(st.st_mode):
+            if not file_path.resolve().is_relative_to(COMFY_OUTPUT_DIR):
+                raise HTTPException(status_code=403, detail="Invalid file path")
+            st = file_path.stat()
+    except OSError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(st.st_mode):
         raise HTTPException(status_code=404, detail="File not found")
     return FileResponse(
         path=file_path,
         filename=filename,
         media_type="application/octet-stream",
+        stat_result=st,
     )
 
 
@@ -145,7 +145,7 @@ mkdir -p /workspace/logs
 # Start FastAPI Remote Executor on port 5001
 echo "Starting FastAPI Remote Executor on port 5001"
 cd /
-python3 -m uvicorn remote_executor:app --host 0.0.0.0 --port 5001 > /workspace/logs/remote_executor.log 2>&1 &
+python3 -m uvicorn remote_executor:app --host 0.0.0.0 --port 5001 --loop uvloop > /workspace/logs/remote_executor.log 2>&1 &
 echo "FastAPI Remote Executor started"
 echo "Log file: /workspace/logs/remote_executor.log"
 